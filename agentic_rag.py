@@ -1,41 +1,146 @@
 import os
 import re
+import multiprocessing
 from pathlib import Path
-from typing import List, Dict, Any
+from itertools import accumulate, chain, islice, repeat
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import heapq
+from typing import List, Dict, Any, AsyncIterable, AsyncIterator, Callable, Optional, Tuple, Union
 import logging
-import json
 import asyncio
 
 from pypdf import PdfReader
 from pypdf.errors import PdfReadError
 import tiktoken
-import jieba
+import orjson
+from rank_bm25 import BM25Okapi
 
-from llm import RouterLLM, ReasoningLLM, VerificationLLM
+# 中文分词优先使用 rjieba（Rust）或 jieba_fast（C），均未安装时回退到纯 Python 的 jieba
+try:
+    import rjieba as _seg
+except ImportError:
+    try:
+        import jieba_fast as _seg
+    except ImportError:
+        import jieba as _seg
+
+from pdf_pages import extract_pages
+from llm import LLM, RouterLLM, JSON_OBJECT_FORMAT, get_router_llm, get_reasoning_llm, get_verification_llm
 
 logger = logging.getLogger(__name__)
 
+# rjieba 只提供返回列表的 cut；jieba / jieba_fast 的 cut 返回生成器，需使用 lcut
+_lcut = getattr(_seg, "lcut", None) or _seg.cut
+# 在导入时构建前缀词典，避免首次分词的初始化开销落在文档处理流程中
+if hasattr(_seg, "initialize"):
+    _seg.initialize()
+
+_RE_FULLWIDTH = re.compile(r'\u3000+')
+_RE_BLANKLINES = re.compile(r'\n\s*\n')
+_RE_SENT_SPLIT = re.compile(r'(?<=[。！？\n])')
+
+# 页数少于该值时串行提取文本：spawn 启动子进程需重新导入模块，小文档上进程池的启动开销远超并行收益
+_PARALLEL_MIN_PAGES = 64
+
+# 模块级共享的 tiktoken 编码器，避免每个实例重复加载词表
+_TOKENIZER = tiktoken.get_encoding("o200k_base")
+# BM25 预筛至少保留的块数
+_BM25_MIN_KEEP = 5
+
+# 延迟预算不低于 Batch API 的完成窗口（24 小时）时，粗滤改走 Batch API
+_BATCH_MIN_LATENCY_MS = 24 * 60 * 60 * 1000
+
+# tiktoken 批量编码的线程数，受 CPU 核数限制
+_ENCODE_THREADS = min(8, os.cpu_count() or 1)
+
+def _terms(text: str) -> List[str]:
+    """分词并去除空白词，供 BM25 打分使用。"""
+    return [t for t in _lcut(text) if t.strip()]
+
+def _token_bound(chunk: "Chunk") -> int:
+    """块的 token 数；未经 BPE 编码时用 UTF-8 字节数作为上界。"""
+    return chunk.token_count if chunk.token_count is not None else len(chunk.text.encode("utf-8"))
+
+def _pack_units(prefix: List[int], budget: int) -> List[Tuple[int, int]]:
+    """按 token 前缀和贪心打包相邻单元，返回每个块的单元区间 [start, stop)。"""
+    bounds = []
+    start, total = 0, len(prefix) - 1
+    while start < total:
+        stop = max(bisect_right(prefix, prefix[start] + budget, start + 1) - 1, start + 1)
+        bounds.append((start, stop))
+        start = stop
+    return bounds
+
+@dataclass(slots=True)
+class Chunk:
+    """文档块。缓存句子及其 token 数、BM25 分词结果，供后续阶段直接复用。
+
+    token_count 为 None 表示未经 BPE 编码、token 数未知，此时 sentence_tokens 为空。
+    """
+    id: int
+    text: str
+    token_count: Optional[int] = None
+    sentences: List[str] = field(default_factory=list)
+    sentence_tokens: List[int] = field(default_factory=list)
+    terms: Optional[List[str]] = None
+
+    @classmethod
+    def from_sentences(cls, chunk_id: int, sentences: List[str], sentence_tokens: List[int]) -> "Chunk":
+        return cls(chunk_id, "".join(sentences), sum(sentence_tokens), sentences, sentence_tokens)
+
 class AgenticRAG:
     """基于 Agentic RAG 方法的文档处理类，用于加载和处理 PDF 文档。"""
 
+    _COARSE_PROMPT_TAIL = (
+        "请评估该块是否包含回答问题的信息，返回严格的 JSON 格式：\n"
+        '{"is_relevant": true, "relevance": 0.8, "reasoning": "文本包含关键信息"}'
+        "\n要求：\n- is_relevant 是布尔值（true/false，无引号）。\n- relevance 是 0.0 到 1.0 的浮点数。"
+        "\n- reasoning 是双引号包裹的字符串。\n- 确保 JSON 格式合法。"
+    )
+    _FINE_PROMPT_TAIL = (
+        "评估该子块是否直接包含答案，返回严格的 JSON 格式：\n{'is_selected': true, 'reasoning': '推理过程'}"
+        "\n要求：\n- is_selected 是布尔值（true/false，无引号）。\n- reasoning 是双引号包裹的字符串。\n- 确保 JSON 格式合法。"
+    )
+
     def __init__(
             self,
             file_path: str,
             user_question: str,
-            router_llm: RouterLLM = RouterLLM(),
+            router_llm: Optional[RouterLLM] = None,
             min_tokens: int = 500,
             max_chunks: int = 20,
-            fine_split: int = 3
+            fine_split: int = 3,
+            tokenizer: tiktoken.Encoding = _TOKENIZER,
+            max_concurrent_llm: int = 5,
+            bm25_prefilter: bool = True,
+            latency_budget_ms: Optional[int] = None,
+            coarse_batch_size: int = 10,
+            coarse_batch_tokens: int = 16000,
+            reasoning_llm: Optional[LLM] = None,
+            verification_llm: Optional[LLM] = None
     ):
         self.file_path = str(Path(file_path))
         self.user_question = user_question
         self.document_text = None
-        self.tokenizer = tiktoken.get_encoding("o200k_base")
+        self.tokenizer = tokenizer
         self.min_tokens = min_tokens
         self.max_chunks = max_chunks
         self.fine_split = fine_split
-        self.router_llm = router_llm
+        # 未显式传入时使用进程内共享的单例
+        self.router_llm = router_llm or get_router_llm()
+        self._reasoning_llm = reasoning_llm
+        self._verification_llm = verification_llm
+        self.bm25_prefilter = bm25_prefilter
+        self.latency_budget_ms = latency_budget_ms
+        # 粗滤时每次 LLM 调用最多评估的块数与块文本的 token 总数（需远小于路由模型的上下文），1 个块时逐块调用
+        self.coarse_batch_size = max(1, coarse_batch_size)
+        self.coarse_batch_tokens = coarse_batch_tokens
         self.chunks = []
+        self._chunk_by_id = {}
+        # 粗滤与精滤共用同一个并发上限
+        self._llm_sem = asyncio.Semaphore(max_concurrent_llm)
 
     def load_local_document(self, max_page: int = 1000) -> str:
         """从本地加载 PDF 文档，返回文本内容。支持中文文档。"""
@@ -44,18 +149,26 @@ class AgenticRAG:
         logger.info(f"正在从 {self.file_path} 加载文档...")
         try:
             pdf_reader = PdfReader(self.file_path)
-            full_text = ""
-            for i, page in enumerate(pdf_reader.pages):
-                if i >= max_page:
-                    break
-                page_text = page.extract_text() or ""
-                full_text += page_text + "\n"
-            full_text = re.sub(r'\u3000+', ' ', full_text)
-            full_text = re.sub(r'\n\s*\n', '\n', full_text.strip())
-            words = jieba.lcut(full_text)
-            word_count = len(words)
-            token_count = len(self.tokenizer.encode(full_text))
-            logger.info(f"文档加载完成：共 {len(pdf_reader.pages)} 页，约 {word_count} 词，{token_count} tokens")
+            page_count = min(max_page, len(pdf_reader.pages))
+            if page_count < _PARALLEL_MIN_PAGES:
+                pages_text = [page.extract_text() or "" for page in islice(pdf_reader.pages, page_count)]
+            else:
+                # 各页相互独立，按页段分发到多个进程并行提取；页段划分得比进程数更细以均衡负载
+                workers = min(os.cpu_count() or 1, page_count)
+                step = max(1, page_count // (workers * 4))
+                starts = range(0, page_count, step)
+                stops = (min(start + step, page_count) for start in starts)
+                # 显式使用 spawn：本方法常在 to_thread 的工作线程中运行，从多线程进程 fork 有死锁风险
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    batches = executor.map(extract_pages, repeat(self.file_path), starts, stops)
+                    pages_text = [text for batch in batches for text in batch]
+            full_text = "\n".join(pages_text) + "\n"
+            full_text = _RE_FULLWIDTH.sub(' ', full_text)
+            full_text = _RE_BLANKLINES.sub('\n', full_text.strip())
+            token_count = self._count_tokens(full_text)
+            logger.info(f"文档加载完成：共 {len(pdf_reader.pages)} 页，{token_count} tokens")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"文档分词统计：约 {len(_lcut(full_text))} 词")
             self.document_text = full_text
             return full_text
         except PdfReadError as e:
@@ -63,77 +176,306 @@ class AgenticRAG:
         except Exception as e:
             raise Exception(f"加载文档时出错：{str(e)}")
 
-    def split_into_chunks(self, min_tokens: int = None) -> List[Dict[str, Any]]:
-        """将文本分成最多 max_chunks 个块，尊重中文句子边界。"""
-        if not self.document_text:
-            return []
+    async def load_local_document_async(self, max_page: int = 1000) -> str:
+        """在线程中执行 load_local_document，避免 PDF 解析阻塞事件循环。"""
+        return await asyncio.to_thread(self.load_local_document, max_page)
+
+    def _count_tokens(self, text: str) -> int:
+        """统计文本 token 数，跳过特殊 token 检查。"""
+        return len(self.tokenizer.encode_ordinary(text))
+
+    def split_into_chunks(self, text: str = None, min_tokens: int = None) -> List[Chunk]:
+        """将文本分成最多 max_chunks 个块，尊重中文句子边界。
+
+        未指定 text 时切分整篇文档并记录到 self.chunks；指定 text 时只返回结果，不修改实例状态。
+        """
         min_tokens = min_tokens or self.min_tokens
-        sentences = [s.strip() for s in re.split(r'(?<=[。！？]|\n)', self.document_text)
-                     if s.strip() and len(s.strip()) > 2]
-
-        chunks = []
-        current_chunk_sentences = []
-        current_chunk_tokens = 0
-
-        for sentence in sentences:
-            sentence_tokens = len(self.tokenizer.encode(sentence))
-            if (current_chunk_tokens + sentence_tokens > min_tokens * 2) and current_chunk_tokens >= min_tokens:
-                chunk_text = "".join(current_chunk_sentences)
-                chunks.append({"id": len(chunks), "text": chunk_text})
-                current_chunk_sentences = [sentence]
-                current_chunk_tokens = sentence_tokens
-            else:
-                current_chunk_sentences.append(sentence)
-                current_chunk_tokens += sentence_tokens
-
-        if current_chunk_sentences:
-            chunk_text = "".join(current_chunk_sentences)
-            chunks.append({"id": len(chunks), "text": chunk_text})
-
-        if len(chunks) > self.max_chunks:
-            all_text = "".join(chunk["text"] for chunk in chunks)
-            sentences = [s.strip() for s in re.split(r'(?<=[。！？]|\n)', all_text)
-                         if s.strip() and len(s.strip()) > 2]
-            sentences_per_chunk = len(sentences) // self.max_chunks + (1 if len(sentences) % self.max_chunks else 0)
-            chunks = []
-            for i in range(0, len(sentences), sentences_per_chunk):
-                chunk_sentences = sentences[i:i + sentences_per_chunk]
-                chunk_text = "".join(chunk_sentences)
-                chunks.append({"id": len(chunks), "text": chunk_text})
+        if text is not None:
+            return self._split_text(text, min_tokens)
+        chunks = self._split_text(self.document_text, min_tokens)
+        self.chunks = chunks
+        self._chunk_by_id = {c.id: c for c in chunks}
+        return chunks
+
+    def _split_text(self, text: str, min_tokens: int) -> List[Chunk]:
+        if not text:
+            return []
+        sentences = [s for s in (part.strip() for part in _RE_SENT_SPLIT.split(text)) if len(s) > 2]
 
+        # UTF-8 字节数是 token 数的上界：全文不超过切分阈值时必然只有一个块，无需 BPE 编码
+        limit = min_tokens * 2
+        if sum(len(s) for s in sentences) <= limit:
+            joined = "".join(sentences)
+            if len(joined.encode("utf-8")) <= limit:
+                chunks = [Chunk(0, joined, sentences=sentences)] if joined else []
+                logger.info(f"文档切分块数合计：{len(chunks)}")
+                return chunks
+
+        # 一次批量编码所有句子（在 Rust 侧并行），替代逐句调用 encode
+        counts = [len(ids) for ids in self.tokenizer.encode_ordinary_batch(sentences, num_threads=_ENCODE_THREADS)]
+        return self._pack_sentences(sentences, counts, min_tokens)
+
+    def _pack_sentences(self, sentences: List[str], counts: List[int], min_tokens: int) -> List[Chunk]:
+        """按 token 预算将已计数的句子打包成块。"""
+        limit = min_tokens * 2
+        units, counts = self._split_oversized(sentences, counts, limit)
+
+        # 句子 token 数的前缀和，任意区间的 token 数可 O(1) 求得
+        prefix = list(accumulate(counts, initial=0))
+        bounds = _pack_units(prefix, limit)
+        if len(bounds) > self.max_chunks:
+            # 放大预算后重新打包一次：每个非末尾块都超过 总数 / max_chunks，块数必不超过 max_chunks
+            budget = -(-prefix[-1] // self.max_chunks) + max(counts)
+            bounds = _pack_units(prefix, budget)
+
+        chunks = [Chunk.from_sentences(i, units[start:stop], counts[start:stop]) for i, (start, stop) in enumerate(bounds)]
         logger.info(f"文档切分块数合计：{len(chunks)}")
-        for i, chunk in enumerate(chunks):
-            token_count = len(self.tokenizer.encode(chunk["text"]))
-            logger.debug(f"Chunk {i}: {token_count} tokens")
-        self.chunks = chunks
+        if logger.isEnabledFor(logging.DEBUG):
+            for chunk in chunks:
+                logger.debug("Chunk %d: %d tokens", chunk.id, chunk.token_count)
         return chunks
 
-    async def coarse_filtration(self, chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """粗滤机制，评估每个块的相关性。"""
-        logger.info("\n==== 粗滤阶段 ====")
-        logger.info(f"正在评估 {len(chunks)} 个文本块的相关性")
+    def _split_oversized(self, units: List[str], counts: List[int], limit: int) -> Tuple[List[str], List[int]]:
+        """将超过 limit 的单句按字符均分，保证每个单元都能放进一个块。"""
+        if all(count <= limit for count in counts):
+            return units, counts
+        split_units = []
+        split_counts = []
+        pieces = []
+        for unit, count in zip(units, counts):
+            if count <= limit:
+                split_units.append(unit)
+                split_counts.append(count)
+                continue
+            step = -(-len(unit) // -(-count // limit))
+            for i in range(0, len(unit), step):
+                pieces.append(len(split_units))
+                split_units.append(unit[i:i + step])
+                split_counts.append(0)
+        # 只对切开的片段重新编码
+        piece_ids = self.tokenizer.encode_ordinary_batch([split_units[i] for i in pieces], num_threads=_ENCODE_THREADS)
+        for i, ids in zip(pieces, piece_ids):
+            split_counts[i] = len(ids)
+        return split_units, split_counts
+
+    def _sub_split(self, chunk: Chunk, min_tokens: int) -> List[Chunk]:
+        """将块细分为子块，复用块上缓存的句子，token 数已知时也一并复用，避免重复分句和 BPE。"""
+        if not chunk.sentences:
+            return self.split_into_chunks(text=chunk.text, min_tokens=min_tokens)
+        if chunk.token_count is None:
+            counts = [len(ids) for ids in self.tokenizer.encode_ordinary_batch(chunk.sentences, num_threads=_ENCODE_THREADS)]
+            return self._pack_sentences(chunk.sentences, counts, min_tokens)
+        return self._pack_sentences(chunk.sentences, chunk.sentence_tokens, min_tokens)
 
-        chunk_messages = []
+    async def stream_pages(self, max_page: int = 1000) -> AsyncIterator[Tuple[int, str]]:
+        """逐页异步提取 PDF 文本，解析工作在线程中进行，不阻塞事件循环。"""
+        if not os.path.exists(self.file_path):
+            raise FileNotFoundError(f"文件 {self.file_path} 不存在，请检查路径！")
+        pdf_reader = await asyncio.to_thread(PdfReader, self.file_path)
+        for i, page in enumerate(islice(pdf_reader.pages, max_page)):
+            page_text = await asyncio.to_thread(page.extract_text)
+            yield i, page_text or ""
+
+    async def stream_chunks(self, max_page: int = 1000, queue_size: int = 8) -> AsyncIterator[Chunk]:
+        """边解析 PDF 边切分，块的 token 数达到预算即产出，使粗滤的 LLM 调用与解析重叠。
+
+        与 split_into_chunks 使用相同的超长句切分与贪心打包，块边界一致；流式切分无法预知总块数，因此不做 max_chunks 重平衡。
+        """
+        logger.info(f"正在从 {self.file_path} 流式加载文档...")
+        page_queue = asyncio.Queue(maxsize=queue_size)
+
+        async def produce_pages():
+            try:
+                async for item in self.stream_pages(max_page):
+                    await page_queue.put(item)
+            finally:
+                await page_queue.put(None)
+
+        producer = asyncio.create_task(produce_pages())
+        self.chunks = []
+        self._chunk_by_id = {}
+        pages_text = []
+        limit = self.min_tokens * 2
+        # 尚未成块的句子：贪心打包时只有最后一个块可能被后续句子继续填充，其余块的边界已确定
+        pending_units = []
+        pending_counts = []
+        try:
+            while (item := await page_queue.get()) is not None:
+                _, page_text = item
+                page_text = _RE_FULLWIDTH.sub(' ', page_text)
+                pages_text.append(page_text)
+                sentences = [s for s in (part.strip() for part in _RE_SENT_SPLIT.split(page_text)) if len(s) > 2]
+                if not sentences:
+                    continue
+                units, counts = await asyncio.to_thread(self._count_units, sentences, limit)
+                pending_units.extend(units)
+                pending_counts.extend(counts)
+                bounds = _pack_units(list(accumulate(pending_counts, initial=0)), limit)
+                for start, stop in bounds[:-1]:
+                    yield self._add_chunk(pending_units[start:stop], pending_counts[start:stop])
+                last_start = bounds[-1][0]
+                pending_units = pending_units[last_start:]
+                pending_counts = pending_counts[last_start:]
+            await producer
+        finally:
+            producer.cancel()
+
+        for start, stop in _pack_units(list(accumulate(pending_counts, initial=0)), limit):
+            yield self._add_chunk(pending_units[start:stop], pending_counts[start:stop])
+        self.document_text = _RE_BLANKLINES.sub('\n', "\n".join(pages_text).strip())
+        logger.info(f"文档流式切分块数合计：{len(self.chunks)}")
+
+    def _count_units(self, sentences: List[str], limit: int) -> Tuple[List[str], List[int]]:
+        """批量编码句子，并切开超过 limit 的单句。"""
+        counts = [len(ids) for ids in self.tokenizer.encode_ordinary_batch(sentences, num_threads=_ENCODE_THREADS)]
+        return self._split_oversized(sentences, counts, limit)
+
+    def _add_chunk(self, units: List[str], counts: List[int]) -> Chunk:
+        """按顺序编号创建块并登记到实例状态。"""
+        chunk = Chunk.from_sentences(len(self.chunks), units, counts)
+        self.chunks.append(chunk)
+        self._chunk_by_id[chunk.id] = chunk
+        return chunk
+
+    async def _chat(self, message: str, stage: int, cache_key: Optional[Tuple[str, str]] = None) -> str:
+        """在并发上限内调用路由模型。"""
+        async with self._llm_sem:
+            return await self.router_llm.chat_completion(message, filtration_stage=stage, cache_key=cache_key)
+
+    def _coarse_message(self, chunk: Chunk) -> str:
+        return f"问题: {self.user_question}\n\n文本块:\n块 {chunk.id}:\n{chunk.text}\n\n" + self._COARSE_PROMPT_TAIL
+
+    def _window_overflows(self, window: List[Chunk], chunk: Chunk) -> bool:
+        """加入 chunk 会使窗口超出 token 预算时返回 True；超出预算的单个块独占一个窗口。"""
+        return bool(window) and sum(map(_token_bound, window)) + _token_bound(chunk) > self.coarse_batch_tokens
+
+    async def _classify_window(self, window: List[Chunk]) -> List[Any]:
+        """评估一组块的相关性，按块返回结果（JSON 字符串、结果字典或异常）。
+
+        单个块走逐块调用；多个块时先逐块查询语义缓存，只把未命中的块合并为一次调用，整组失败时这些块都记为该异常。
+        """
+        if len(window) == 1:
+            try:
+                chunk = window[0]
+                return [await self._chat(self._coarse_message(chunk), 0, (self.user_question, chunk.text))]
+            except Exception as error:
+                return [error]
+        results = [None] * len(window)
+        vectors = [None] * len(window)
+        cache = self.router_llm.semantic_cache
+        if cache is not None:
+            lookups = await asyncio.gather(*(cache.get(self.user_question, chunk.text) for chunk in window))
+            for i, (cached, vector) in enumerate(lookups):
+                results[i], vectors[i] = cached, vector
+        pending = [i for i, result in enumerate(results) if result is None]
+        if not pending:
+            return results
+        try:
+            async with self._llm_sem:
+                batch = await self.router_llm.batch_classify(
+                    self.user_question, [(window[i].id, window[i].text) for i in pending])
+        except Exception as error:
+            batch = [error] * len(pending)
+        for i, result in zip(pending, batch):
+            if result is None:
+                result = ValueError("批量响应中缺少该块的结果")
+            elif isinstance(result, dict) and vectors[i] is not None:
+                # 按块写回缓存，逐块与批量两条路径可以互相命中
+                await cache.set(vectors[i], window[i].text, orjson.dumps(result).decode())
+            results[i] = result
+        return results
+
+    def _bm25_filter(self, chunks: List[Chunk]) -> Tuple[List[Chunk], Dict[int, Dict[str, Any]]]:
+        """用 BM25 对问题做词法打分，只保留得分靠前的块送入 LLM，其余块直接记为不相关。"""
+        keep = max(_BM25_MIN_KEEP, len(chunks) // 2)
+        if len(chunks) <= keep:
+            return chunks, {}
         for chunk in chunks:
-            message = f"问题: {self.user_question}\n\n文本块:\n块 {chunk['id']}:\n{chunk['text']}\n\n"
-            message += "请评估该块是否包含回答问题的信息，返回严格的 JSON 格式：\n"
-            message += '{"is_relevant": true, "relevance": 0.8, "reasoning": "文本包含关键信息"}'
-            message += "\n要求：\n- is_relevant 是布尔值（true/false，无引号）。\n- relevance 是 0.0 到 1.0 的浮点数。\n- reasoning 是双引号包裹的字符串。\n- 确保 JSON 格式合法。"
-            chunk_messages.append((chunk['id'], message))
+            if chunk.terms is None:
+                chunk.terms = _terms(chunk.text)
+        scores = BM25Okapi([chunk.terms for chunk in chunks]).get_scores(_terms(self.user_question))
+        # 与问题有词项重合的块不足 keep 个时（如问题经过改写或与文档语言不同），词法得分无法区分剩余的块，跳过预筛
+        if sum(1 for score in scores if score > 0) < keep:
+            logger.info("BM25 预筛：与问题有词项重合的块过少，跳过预筛")
+            return chunks, {}
+        ranked = sorted(range(len(chunks)), key=lambda i: scores[i], reverse=True)
+        max_score = float(scores[ranked[0]])
 
-        semaphore = asyncio.Semaphore(5)
-        async def limited_chat_completion(msg):
-            async with semaphore:
-                return await self.router_llm.chat_completion(msg, filtration_stage=0)
+        survivors = [chunks[i] for i in sorted(ranked[:keep])]
+        scratchpad = {}
+        for i in ranked[keep:]:
+            bm25_score = float(scores[i]) / max_score
+            # relevance 留给 LLM 的判断，以免预筛得分在精滤排序中盖过 LLM 评估过的块
+            scratchpad[chunks[i].id] = {
+                "is_relevant": False,
+                "relevance": 0.0,
+                "bm25": round(max(bm25_score, 0.0), 4),
+                "reasoning": "BM25 预筛未通过"
+            }
+        logger.info(f"BM25 预筛：保留 {len(survivors)} 个块，跳过 {len(scratchpad)} 个块")
+        return survivors, scratchpad
 
-        tasks = [limited_chat_completion(message) for _, message in chunk_messages]
-        responses = await asyncio.gather(*tasks)
+    async def coarse_filtration(
+            self,
+            chunks: Union[List[Chunk], AsyncIterable[Chunk]]
+    ) -> Dict[str, Any]:
+        """粗滤机制，评估每个块的相关性。
+
+        相邻的块按 coarse_batch_size 个、coarse_batch_tokens 个 token 为上限分组，每组一次 LLM 调用。
+        chunks 也可以是 stream_chunks() 返回的异步迭代器，此时每凑满一组块就发起调用（不做 BM25 预筛）。
+        """
+        logger.info("\n==== 粗滤阶段 ====")
 
-        selected_ids = []
         scratchpad = {}
-        for (chunk_id, _), response in zip(chunk_messages, responses):
+        chunk_ids = []
+        tasks = []
+        responses = None
+        if isinstance(chunks, AsyncIterable):
+            window = []
+            async for chunk in chunks:
+                chunk_ids.append(chunk.id)
+                if self._window_overflows(window, chunk):
+                    tasks.append(asyncio.create_task(self._classify_window(window)))
+                    window = []
+                window.append(chunk)
+                if len(window) >= self.coarse_batch_size:
+                    tasks.append(asyncio.create_task(self._classify_window(window)))
+                    window = []
+            if window:
+                tasks.append(asyncio.create_task(self._classify_window(window)))
+        else:
+            logger.info(f"正在评估 {len(chunks)} 个文本块的相关性")
+            if self.bm25_prefilter:
+                chunks, scratchpad = self._bm25_filter(chunks)
+            chunk_ids = [chunk.id for chunk in chunks]
+            if self.latency_budget_ms is not None and self.latency_budget_ms >= _BATCH_MIN_LATENCY_MS:
+                logger.info("延迟预算充足，粗滤请求改为通过 Batch API 提交")
+                responses = await self.router_llm.chat_completions_batch(
+                    [self._coarse_message(chunk) for chunk in chunks], filtration_stage=0)
+            else:
+                window = []
+                for chunk in chunks:
+                    if self._window_overflows(window, chunk):
+                        tasks.append(self._classify_window(window))
+                        window = []
+                    window.append(chunk)
+                    if len(window) >= self.coarse_batch_size:
+                        tasks.append(self._classify_window(window))
+                        window = []
+                if window:
+                    tasks.append(self._classify_window(window))
+        if responses is None:
+            # 单个调用失败（如 429）不应中断整批：_classify_window 按块返回异常，不会抛出
+            responses = list(chain.from_iterable(await asyncio.gather(*tasks)))
+
+        selected_ids = []
+        for chunk_id, response in zip(chunk_ids, responses):
+            if isinstance(response, BaseException):
+                logger.warning(f"警告：块 {chunk_id} 的 LLM 调用失败: {response!r}")
+                scratchpad[chunk_id] = {"is_relevant": False, "relevance": 0.0, "reasoning": f"调用失败: {response!r}"}
+                continue
             try:
-                result = json.loads(response)
+                result = response if isinstance(response, dict) else orjson.loads(response)
                 is_relevant = result.get("is_relevant", False)
                 relevance = float(result.get("relevance", 0.0))
                 reasoning = result.get("reasoning", "未提供推理")
@@ -145,71 +487,81 @@ class AgenticRAG:
                 scratchpad[chunk_id] = {"is_relevant": is_relevant, "relevance": relevance, "reasoning": reasoning}
                 if is_relevant:
                     selected_ids.append(chunk_id)
-            except json.JSONDecodeError as e:
+            except orjson.JSONDecodeError as e:
                 logger.warning(f"警告：块 {chunk_id} 的响应无法解析为 JSON: {response}, 错误: {str(e)}")
                 scratchpad[chunk_id] = {"is_relevant": False, "relevance": 0.0, "reasoning": f"解析错误: {response}"}
 
         logger.info(f"选中的块: {', '.join(str(id) for id in selected_ids)}")
-        logger.debug(f"Scratchpad 记录: {json.dumps(scratchpad, indent=2, ensure_ascii=False)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Scratchpad 记录: {orjson.dumps(scratchpad, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()}")
         return {"selected_ids": selected_ids, "scratchpad": scratchpad}
 
     async def fine_filtration(self, scratchpad: Dict[str, Any], max_selected_chunks: int = 3) -> Dict:
         """精滤机制，进一步筛选子块。"""
         logger.info("\n==== 精滤阶段 ====")
-        sorted_chunks = sorted(scratchpad.items(), key=lambda x: x[1]["relevance"], reverse=True)[:max_selected_chunks]
+        sorted_chunks = heapq.nlargest(max_selected_chunks, scratchpad.items(), key=lambda x: x[1]["relevance"])
         selected_chunk_ids = [chunk_id for chunk_id, _ in sorted_chunks]
         logger.info(f"选中的块 ID: {selected_chunk_ids}")
 
+        selected_chunks = [self._chunk_by_id[chunk_id] for chunk_id in selected_chunk_ids]
+        fine_chunks_list = await asyncio.gather(
+            *(asyncio.to_thread(self._sub_split, chunk, 100) for chunk in selected_chunks)
+        )
         sub_chunks = []
-        for chunk_id in selected_chunk_ids:
-            chunk_text = next(chunk["text"] for chunk in self.chunks if chunk["id"] == chunk_id)
-            self.document_text = chunk_text
-            fine_chunks = self.split_into_chunks(min_tokens=100)
+        for fine_chunks in fine_chunks_list:
             sub_chunks.extend(fine_chunks[:self.fine_split])
 
+        scratchpad_json = orjson.dumps(scratchpad, option=orjson.OPT_NON_STR_KEYS).decode()
         messages = []
         for sub_chunk in sub_chunks:
-            message = f"问题: {self.user_question}\n\n子块:\n{sub_chunk['text']}\n\n粗滤上下文:\n{json.dumps(scratchpad, ensure_ascii=False)}\n\n"
-            message += "评估该子块是否直接包含答案，返回严格的 JSON 格式：\n{'is_selected': true, 'reasoning': '推理过程'}"
-            message += "\n要求：\n- is_selected 是布尔值（true/false，无引号）。\n- reasoning 是双引号包裹的字符串。\n- 确保 JSON 格式合法。"
+            message = f"问题: {self.user_question}\n\n子块:\n{sub_chunk.text}\n\n粗滤上下文:\n{scratchpad_json}\n\n" + self._FINE_PROMPT_TAIL
             messages.append((sub_chunk, message))
 
-        semaphore = asyncio.Semaphore(5)
-        async def limited_chat_completion(msg):
-            async with semaphore:
-                return await self.router_llm.chat_completion(msg, filtration_stage=1)
-
-        tasks = [limited_chat_completion(msg) for _, msg in messages]
-        responses = await asyncio.gather(*tasks)
+        tasks = [self._chat(msg, 1) for _, msg in messages]
+        responses = await asyncio.gather(*tasks, return_exceptions=True)
 
         selected_sub_chunks = []
         fine_scratchpad = []
         for (sub_chunk, _), response in zip(messages, responses):
+            if isinstance(response, BaseException):
+                logger.warning(f"警告：子块 {sub_chunk.id} 的 LLM 调用失败: {response!r}")
+                fine_scratchpad.append(f"调用失败: {response!r}")
+                continue
             try:
-                result = json.loads(response)
+                result = orjson.loads(response)
                 is_selected = result.get("is_selected", False)
                 reasoning = result.get("reasoning", "未提供推理")
                 if isinstance(is_selected, str):
                     is_selected = is_selected.lower() == "true"
                 if is_selected:
-                    selected_sub_chunks.append(sub_chunk["text"])
+                    selected_sub_chunks.append(sub_chunk.text)
                     fine_scratchpad.append(reasoning)
-            except json.JSONDecodeError:
-                logger.warning(f"警告：子块 {sub_chunk['id']} 的响应无法解析为 JSON: {response}")
+            except orjson.JSONDecodeError:
+                logger.warning(f"警告：子块 {sub_chunk.id} 的响应无法解析为 JSON: {response}")
                 fine_scratchpad.append(f"解析错误: {response}")
 
         logger.info(f"选中的子块数: {len(selected_sub_chunks)}")
         return {"selected_sub_chunks": selected_sub_chunks, "scratchpad": fine_scratchpad}
 
-    def generate_answer(self, question: str, paragraphs: List[Dict]) -> Dict:
-        """基于筛选的子块生成答案。"""
+    async def generate_answer(
+            self,
+            question: str,
+            paragraphs: List[Dict],
+            on_delta: Optional[Callable[[str], None]] = None
+    ) -> Dict:
+        """基于筛选的子块流式生成答案，每收到一段增量文本即回调 on_delta。"""
         logger.info("\n=== 生成答案阶段 ===")
-        reasoning_llm = ReasoningLLM()
+        reasoning_llm = self._reasoning_llm or get_reasoning_llm()
         sorted_paragraphs = sorted(paragraphs, key=lambda x: x['id'])
         context = "\n".join([f"文本块 {p['id']}:\n{p['text']}" for p in sorted_paragraphs])
         message = f"问题: {question}\n文档块集合:\n{context}\n请根据文档内容回答问题。"
         try:
-            answer = reasoning_llm.chat_completion(message)
+            parts = []
+            async for delta in reasoning_llm.stream_chat_completion(message):
+                parts.append(delta)
+                if on_delta is not None:
+                    on_delta(delta)
+            answer = "".join(parts).strip()
             logger.info(f"生成答案: {answer}")
             return {"answer": answer, "source_chunks": [p['id'] for p in sorted_paragraphs], "status": "success"}
         except Exception as e:
@@ -219,19 +571,20 @@ class AgenticRAG:
     def verify_answer(self, question: str, answer: Dict) -> bool:
         """验证答案准确性。"""
         logger.info("\n=== 验证答案阶段 ===")
-        verification_llm = VerificationLLM()
+        verification_llm = self._verification_llm or get_verification_llm()
         if not answer.get("answer") or answer.get("status") != "success":
             logger.warning("验证失败：答案无效或生成失败")
             return False
         answer_text = answer["answer"]
-        result = verification_llm.chat_completion(question, answer_text)
+        message = f"问题: {question}\n答案: {answer_text}\n请验证答案的准确性并返回 JSON 格式的结果。"
+        result = verification_llm.sync_chat_completion(message, response_format=JSON_OBJECT_FORMAT)
         logger.debug(f"验证结果: {result}")
         try:
-            verification_result = json.loads(result)
+            verification_result = orjson.loads(result)
             is_correct = verification_result.get("is_correct", False)
             logger.info(f"验证推理: {verification_result.get('reasoning', '未提供推理')}")
             return bool(is_correct)
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logger.warning(f"验证结果解析失败: {result}, 错误: {str(e)}")
             return False
 
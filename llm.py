@@ -1,26 +1,151 @@
 import os
 from dotenv import load_dotenv
 import asyncio
+import atexit
+import functools
+import hashlib
+import json
 import logging
+import random
+import re
+import uuid
+from typing import Any, AsyncIterator, Final, List, Optional, Tuple, Type, TypeVar
 
-from openai import OpenAI, AsyncOpenAI, APIConnectionError, APITimeoutError
-from openai.types.chat import ChatCompletionSystemMessageParam, ChatCompletionUserMessageParam
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential, before_sleep_log
+import diskcache
+import httpx
+
+from openai import (
+    OpenAI, AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError, NOT_GIVEN
+)
+from pydantic import BaseModel
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, before_sleep_log, RetryCallState
 
 load_dotenv()
 logger = logging.getLogger(__name__)
 
-def async_retry_on_timeout():
+T = TypeVar("T", bound=BaseModel)
+
+# JSON 模式：由服务端保证返回合法的 JSON 对象
+JSON_OBJECT_FORMAT = {"type": "json_object"}
+
+# 为系统提示词加上 cache_control 标记（Anthropic 风格的提示词缓存）。
+# OpenAI 兼容接口对相同前缀自动缓存，不识别该字段，因此默认关闭。
+_CACHE_CONTROL_ENABLED = os.getenv("LLM_CACHE_CONTROL", "").lower() in ("1", "true", "yes")
+
+async def _log_http_version(response: httpx.Response):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"{response.request.url.host} 使用 {response.http_version}")
+
+# 所有 LLM 实例共享的 HTTP 连接池，复用 TCP/TLS 连接；异步客户端启用 HTTP/2，并发请求复用同一连接。
+# 连接池在首次使用时创建，close_http_clients 关闭后下次使用会重新创建。
+_HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+_HTTP_TIMEOUT = httpx.Timeout(connect=5, read=60, write=10, pool=5)
+_http_async = None
+_http_sync = None
+# 关闭 OpenAI SDK 自身的重试：限流、5xx 与超时的退避统一由 retry_on_transient_error 负责，避免两层重试次数相乘
+_SDK_MAX_RETRIES = 0
+
+def _get_http_async() -> httpx.AsyncClient:
+    global _http_async
+    if _http_async is None:
+        _http_async = httpx.AsyncClient(
+            http2=True, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT,
+            event_hooks={"response": [_log_http_version]}
+        )
+    return _http_async
+
+def _get_http_sync() -> httpx.Client:
+    global _http_sync
+    if _http_sync is None:
+        _http_sync = httpx.Client(limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT)
+    return _http_sync
+
+def _close_http_sync():
+    global _http_sync
+    if _http_sync is not None:
+        _http_sync.close()
+        _http_sync = None
+
+atexit.register(_close_http_sync)
+
+# 精确匹配的本地响应缓存：默认关闭，仅对温度不高于阈值的（近似确定性的）调用生效
+_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.3"))
+_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "./.llm_cache")
+_CACHE_TTL = 86400
+_cache = None
+
+def _get_cache() -> diskcache.Cache:
+    global _cache
+    if _cache is None:
+        _cache = diskcache.Cache(_CACHE_DIR)
+    return _cache
+
+def _read_model_env(prefix: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    return (
+        os.getenv(f"{prefix}_MODEL_NAME"),
+        os.getenv(f"{prefix}_MODEL_BASE_URL"),
+        os.getenv(f"{prefix}_MODEL_API_KEY")
+    )
+
+# 各模型的环境变量在导入时统一解析一次，实例化时不再重复读取
+_MODEL_ENV: Final[dict] = {prefix: _read_model_env(prefix) for prefix in ("ROUTER", "REASONING", "VERIFICATION")}
+_ROUTER_MAX_CONCURRENCY: Final[int] = int(os.getenv("ROUTER_MAX_CONCURRENCY", "20"))
+# 各角色的输出 token 上限，经环境变量配置，默认不限制。
+# 推理类模型（如 OpenRouter 上的 deepseek-r1t-chimera、gemini-2.5-flash）的思考 token 也计入上限，设得过小会得到截断或空的 JSON。
+_ROUTER_MAX_TOKENS: Final[Optional[int]] = int(os.getenv("ROUTER_MAX_TOKENS", "0")) or None
+_VERIFICATION_MAX_TOKENS: Final[Optional[int]] = int(os.getenv("VERIFICATION_MAX_TOKENS", "0")) or None
+_REASONING_MAX_TOKENS: Final[Optional[int]] = int(os.getenv("REASONING_MAX_TOKENS", "0")) or None
+
+def _require_model_env(prefix: str, env: Tuple[Optional[str], Optional[str], Optional[str]]) -> Tuple[str, str, str]:
+    """校验模型配置是否完整，缺失时抛出 ValueError。"""
+    for suffix, value in zip(("MODEL_NAME", "MODEL_BASE_URL", "MODEL_API_KEY"), env):
+        if not value:
+            raise ValueError(f"{prefix}_{suffix} 环境变量未设置，请在 .env 文件中配置")
+    return env
+
+async def close_http_clients():
+    """关闭共享的 HTTP 客户端并清空 LLM 单例，应在事件循环结束前调用。
+
+    单例持有的客户端与信号量都绑定在当前事件循环上，清空后下一次 asyncio.run 会重新创建。
+    """
+    global _http_async
+    if _http_async is not None:
+        await _http_async.aclose()
+        _http_async = None
+    _close_http_sync()
+    for getter in (get_router_llm, get_parser_llm, get_reasoning_llm, get_verification_llm):
+        getter.cache_clear()
+
+# 单次重试等待的上限：防止服务端返回过大的 Retry-After 使请求长时间挂起
+_MAX_RETRY_WAIT = 60.0
+
+def _wait_with_jitter(retry_state: RetryCallState) -> float:
+    """带抖动的退避时间，避免并发任务同步重试；服务端返回 Retry-After 时取两者中较大的值，且不超过 _MAX_RETRY_WAIT。"""
+    wait = min(30.0, random.uniform(1, retry_state.attempt_number * 3))
+    error = retry_state.outcome.exception() if retry_state.outcome else None
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            wait = max(wait, float(response.headers.get("retry-after")))
+        except (TypeError, ValueError):
+            pass
+    return min(wait, _MAX_RETRY_WAIT)
+
+def retry_on_transient_error():
     return retry(
-        retry=retry_if_exception_type((APITimeoutError, APIConnectionError, asyncio.TimeoutError)),
+        retry=retry_if_exception_type(
+            (APITimeoutError, APIConnectionError, asyncio.TimeoutError, RateLimitError, InternalServerError)
+        ),
         stop=stop_after_attempt(3),
-        wait=wait_random_exponential(multiplier=1, max=30),
+        wait=_wait_with_jitter,
         before_sleep=before_sleep_log(logger, logging.WARNING),
         reraise=True
     )
 
 class LLM:
-    def __init__(self, model_name: str, base_url: str, api_key: str, temperature: float = 0.5, is_async: bool = False):
+    def __init__(self, model_name: str, base_url: str, api_key: str, temperature: float = 0.5, is_async: bool = False,
+                 max_tokens: Optional[int] = None, system_prompt: Optional[str] = None):
         if not model_name:
             raise ValueError("model_name 不能为空")
         if not base_url:
@@ -29,59 +154,290 @@ class LLM:
             raise ValueError("api_key 不能为空")
         self.model = model_name
         self.temperature = temperature
-        self.client = AsyncOpenAI(base_url=base_url, api_key=api_key) if is_async else OpenAI(base_url=base_url, api_key=api_key)
+        self.max_tokens = max_tokens
+        # 预设的系统提示词，调用时未显式传入提示词则使用它
+        self.system_prompt = system_prompt
+        # 系统消息按 (提示词, 是否加 cache_control) 缓存，每个提示词只构造一次
+        self._sys_msgs = {}
+        self.use_cache = _CACHE_ENABLED and temperature <= _CACHE_MAX_TEMPERATURE
+        if is_async:
+            self.client = AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=_get_http_async(), max_retries=_SDK_MAX_RETRIES)
+        else:
+            self.client = OpenAI(base_url=base_url, api_key=api_key, http_client=_get_http_sync(), max_retries=_SDK_MAX_RETRIES)
+
+    def _cache_key(
+            self,
+            message: str,
+            system_prompt: str,
+            response_format: Optional[dict] = None,
+            max_tokens: Optional[int] = None
+    ) -> str:
+        max_tokens = max_tokens or self.max_tokens
+        payload = json.dumps([self.model, system_prompt, message, self.temperature, max_tokens, response_format], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _build_messages(self, message: str, system_prompt: str, cache_prompt: bool = True) -> list:
+        """系统提示词始终放在最前面，使其成为各次调用间可复用的稳定前缀。"""
+        cache_control = cache_prompt and _CACHE_CONTROL_ENABLED
+        system_message = self._sys_msgs.get((system_prompt, cache_control))
+        if system_message is None:
+            if cache_control:
+                system_message = {
+                    "role": "system",
+                    "content": [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+                }
+            else:
+                system_message = {"role": "system", "content": system_prompt}
+            self._sys_msgs[(system_prompt, cache_control)] = system_message
+        return [system_message, {"role": "user", "content": message}]
+
+    @retry_on_transient_error()
+    async def _acreate(self, **kwargs):
+        return await self.client.chat.completions.create(**kwargs)
+
+    @retry_on_transient_error()
+    def _create(self, **kwargs):
+        return self.client.chat.completions.create(**kwargs)
 
-    @async_retry_on_timeout()
-    async def async_chat_completion(self, message: str, system_prompt: str) -> str:
+    @retry_on_transient_error()
+    def _parse(self, **kwargs):
+        return self.client.chat.completions.parse(**kwargs)
+
+    @retry_on_transient_error()
+    async def _acall(self, method, *args, **kwargs):
+        """以统一的重试策略调用任意异步 SDK 方法（如文件与 Batch 接口）。"""
+        return await method(*args, **kwargs)
+
+    async def async_chat_completion(
+            self,
+            message: str,
+            system_prompt: Optional[str] = None,
+            response_format: Optional[dict] = None,
+            cache_prompt: bool = True,
+            max_tokens: Optional[int] = None
+    ) -> str:
+        """system_prompt、max_tokens 未指定时使用实例的预设值。"""
+        system_prompt = system_prompt or self.system_prompt
+        key = self._cache_key(message, system_prompt, response_format, max_tokens) if self.use_cache else None
+        if key is not None and (cached := _get_cache().get(key)) is not None:
+            return cached
         try:
-            response = await self.client.chat.completions.create(
+            response = await self._acreate(
                 model=self.model,
-                messages=[
-                    ChatCompletionSystemMessageParam(role="system", content=system_prompt),
-                    ChatCompletionUserMessageParam(role="user", content=message)
-                ],
+                messages=self._build_messages(message, system_prompt, cache_prompt),
                 temperature=self.temperature,
+                max_tokens=max_tokens or self.max_tokens or NOT_GIVEN,
+                response_format=response_format or NOT_GIVEN,
                 timeout=30
             )
-            return response.choices[0].message.content.strip()
+            content = response.choices[0].message.content.strip()
+            if key is not None:
+                _get_cache().set(key, content, expire=_CACHE_TTL)
+            return content
         except Exception as error:
             return f"错误: {str(error)}"
 
-    def sync_chat_completion(self, message: str, system_prompt: str) -> str:
+    async def stream_chat_completion(
+            self,
+            message: str,
+            system_prompt: Optional[str] = None,
+            cache_prompt: bool = True
+    ) -> AsyncIterator[str]:
+        """流式生成，逐段返回增量文本；出错时直接抛出异常，由调用方处理。"""
+        system_prompt = system_prompt or self.system_prompt
+        stream = await self._acreate(
+            model=self.model,
+            messages=self._build_messages(message, system_prompt, cache_prompt),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens or NOT_GIVEN,
+            stream=True,
+            timeout=30
+        )
+        async for chunk in stream:
+            if chunk.choices and (delta := chunk.choices[0].delta.content):
+                yield delta
+
+    def sync_chat_completion(
+            self,
+            message: str,
+            system_prompt: Optional[str] = None,
+            response_format: Optional[dict] = None,
+            cache_prompt: bool = True
+    ) -> str:
+        system_prompt = system_prompt or self.system_prompt
+        key = self._cache_key(message, system_prompt, response_format) if self.use_cache else None
+        if key is not None and (cached := _get_cache().get(key)) is not None:
+            return cached
         try:
-            response = self.client.chat.completions.create(
+            response = self._create(
                 model=self.model,
-                messages=[
-                    ChatCompletionSystemMessageParam(role="system", content=system_prompt),
-                    ChatCompletionUserMessageParam(role="user", content=message)
-                ],
+                messages=self._build_messages(message, system_prompt, cache_prompt),
                 temperature=self.temperature,
+                max_tokens=self.max_tokens or NOT_GIVEN,
+                response_format=response_format or NOT_GIVEN,
                 timeout=30
             )
-            return response.choices[0].message.content.strip()
+            content = response.choices[0].message.content.strip()
+            if key is not None:
+                _get_cache().set(key, content, expire=_CACHE_TTL)
+            return content
         except Exception as error:
             return f"错误: {str(error)}"
 
-class RouterLLM(LLM):
-    def __init__(self):
-        model_name = os.getenv("ROUTER_MODEL_NAME")
-        base_url = os.getenv("ROUTER_MODEL_BASE_URL")
-        api_key = os.getenv("ROUTER_MODEL_API_KEY")
-        if not model_name:
-            raise ValueError("ROUTER_MODEL_NAME 环境变量未设置，请在 .env 文件中配置")
-        if not base_url:
-            raise ValueError("ROUTER_MODEL_BASE_URL 环境变量未设置，请在 .env 文件中配置")
-        if not api_key:
-            raise ValueError("ROUTER_MODEL_API_KEY 环境变量未设置，请在 .env 文件中配置")
-        super().__init__(model_name=model_name, base_url=base_url, api_key=api_key, temperature=0.5, is_async=True)
+    def sync_parse_completion(self, message: str, system_prompt: Optional[str], response_model: Type[T]) -> T:
+        """结构化输出：由 SDK 按 Pydantic 模型约束并校验响应，重试后仍失败时抛出异常。system_prompt 为 None 时使用预设值。"""
+        system_prompt = system_prompt or self.system_prompt
+        key = self._cache_key(message, system_prompt, response_model.model_json_schema()) if self.use_cache else None
+        if key is not None and (cached := _get_cache().get(key)) is not None:
+            return response_model.model_validate_json(cached)
+        response = self._parse(
+            model=self.model,
+            messages=self._build_messages(message, system_prompt),
+            temperature=self.temperature,
+            max_tokens=self.max_tokens or NOT_GIVEN,
+            response_format=response_model,
+            timeout=30
+        )
+        parsed = response.choices[0].message.parsed
+        if parsed is None:
+            raise ValueError(f"模型未返回结构化结果：{response.choices[0].message.refusal}")
+        if key is not None:
+            _get_cache().set(key, parsed.model_dump_json(), expire=_CACHE_TTL)
+        return parsed
 
-    async def chat_completion(self, message: str, filtration_stage: int = 0) -> str:
-        system_prompt = self.get_system_prompt(filtration_stage)
-        return await self.async_chat_completion(message, system_prompt)
+def _escape_tag(value: str) -> str:
+    """转义 RediSearch TAG 查询中的标点与空白。"""
+    return re.sub(r"(\W)", r"\\\1", value)
 
-    def get_system_prompt(self, filtration_stage: int) -> str:
-        if filtration_stage == 0:
-            return """
+class SemanticCache:
+    """粗滤判断的语义缓存，存储于 Redis（RediSearch HNSW 索引），按向量维度分区建索引。
+
+    路由模型名与块文本的 sha256 作为 TAG 字段精确过滤，只对用户问题的嵌入做近邻匹配：同一模型对同一块的判断，
+    仅在问题近似重复（余弦相似度不低于 threshold）时复用。依赖可选的 redis 与 numpy，
+    Redis 或嵌入接口出错时只记录警告并视为未命中，不影响主流程。
+    """
+
+    def __init__(
+            self,
+            redis_url: str,
+            embedding_client: AsyncOpenAI,
+            embedding_model: str,
+            model: str,
+            threshold: float = 0.97,
+            ttl: int = 86400
+    ):
+        import redis.asyncio as redis
+
+        self._redis = redis.from_url(redis_url)
+        self._embedding_client = embedding_client
+        self.embedding_model = embedding_model
+        self.model = model
+        self.threshold = threshold
+        self.ttl = ttl
+        self._indexes = set()
+        # 同一问题会对每个块各查一次，嵌入按问题复用（含进行中的请求）
+        self._vectors = {}
+
+    async def _embed(self, text: str):
+        import numpy as np
+
+        response = await self._embedding_client.embeddings.create(model=self.embedding_model, input=text)
+        return np.asarray(response.data[0].embedding, dtype=np.float32)
+
+    async def _question_vector(self, question: str):
+        task = self._vectors.get(question)
+        if task is None:
+            if len(self._vectors) >= 256:
+                self._vectors.clear()
+            task = self._vectors[question] = asyncio.ensure_future(self._embed(question))
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            self._vectors.pop(question, None)
+            raise
+
+    async def _ensure_index(self, dim: int) -> str:
+        from redis.commands.search.field import TagField, VectorField
+        try:
+            from redis.commands.search.index_definition import IndexDefinition, IndexType
+        except ImportError:
+            # redis-py 5.x 的模块名
+            from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+        from redis.exceptions import ResponseError
+
+        name = f"llm_semcache:coarse:{dim}"
+        if name in self._indexes:
+            return name
+        try:
+            await self._redis.ft(name).info()
+        except ResponseError:
+            await self._redis.ft(name).create_index(
+                [
+                    TagField("model"),
+                    TagField("chunk"),
+                    VectorField("embedding", "HNSW", {"TYPE": "FLOAT32", "DIM": dim, "DISTANCE_METRIC": "COSINE"})
+                ],
+                definition=IndexDefinition(prefix=[f"{name}:"], index_type=IndexType.HASH)
+            )
+        self._indexes.add(name)
+        return name
+
+    async def get(self, question: str, chunk_text: str) -> Tuple[Optional[str], Any]:
+        """返回 (缓存的判断或 None, 问题的嵌入向量)，向量可直接传给 set 以免重复计算。"""
+        from redis.commands.search.query import Query
+
+        try:
+            vector = await self._question_vector(question)
+            name = await self._ensure_index(len(vector))
+            chunk = hashlib.sha256(chunk_text.encode("utf-8")).hexdigest()
+            query = (
+                Query(f"(@model:{{{_escape_tag(self.model)}}} @chunk:{{{chunk}}})=>[KNN 1 @embedding $vec AS distance]")
+                .return_fields("response", "distance")
+                .dialect(2)
+            )
+            result = await self._redis.ft(name).search(query, query_params={"vec": vector.tobytes()})
+        except Exception as error:
+            logger.warning(f"语义缓存查询失败: {error!r}")
+            return None, None
+        if result.docs and 1 - float(result.docs[0].distance) >= self.threshold:
+            response = result.docs[0].response
+            return (response.decode("utf-8") if isinstance(response, bytes) else response), vector
+        return None, vector
+
+    async def set(self, vector: Any, chunk_text: str, response: str):
+        try:
+            name = await self._ensure_index(len(vector))
+            key = f"{name}:{uuid.uuid4().hex}"
+            await self._redis.hset(key, mapping={
+                "model": self.model,
+                "chunk": hashlib.sha256(chunk_text.encode("utf-8")).hexdigest(),
+                "response": response,
+                "embedding": vector.tobytes()
+            })
+            await self._redis.expire(key, self.ttl)
+        except Exception as error:
+            logger.warning(f"语义缓存写入失败: {error!r}")
+
+def _make_semantic_cache(base_url: str, api_key: str, model: str) -> Optional[SemanticCache]:
+    """根据环境变量创建语义缓存；未启用时返回 None。嵌入接口默认沿用路由模型的地址与密钥。"""
+    if os.getenv("SEMANTIC_CACHE_ENABLED", "").lower() not in ("1", "true", "yes"):
+        return None
+    embedding_client = AsyncOpenAI(
+        base_url=os.getenv("EMBEDDING_MODEL_BASE_URL") or base_url,
+        api_key=os.getenv("EMBEDDING_MODEL_API_KEY") or api_key,
+        http_client=_get_http_async(),
+        max_retries=_SDK_MAX_RETRIES
+    )
+    return SemanticCache(
+        redis_url=os.getenv("SEMANTIC_CACHE_REDIS_URL", "redis://localhost:6379/0"),
+        embedding_client=embedding_client,
+        embedding_model=os.getenv("EMBEDDING_MODEL_NAME", "text-embedding-3-small"),
+        model=model,
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+    )
+
+# 各模型的系统提示词，定义为模块级常量，每次调用直接引用同一对象
+_ROUTER_STAGE0_PROMPT: Final[str] = """
 你是一个文档导航助手。你的任务是：
 1. 确定文本块是否可能包含回答用户问题的信息。
 2. 在 scratchpad 中记录你的推理过程。
@@ -96,8 +452,7 @@ class RouterLLM(LLM):
    - reasoning 是双引号包裹的字符串。
    - 确保 JSON 格式合法，无多余空格或换行。
 """
-        elif filtration_stage == 1:
-            return """
+_ROUTER_STAGE1_PROMPT: Final[str] = """
 你是一个文档分析专家，专职于为解答用户问题查找文档片段。
 你的目标是：
 1. 严格判断子块是否直接提供问题的准确答案或关键事实。
@@ -110,47 +465,60 @@ class RouterLLM(LLM):
    - reasoning 是双引号包裹的字符串。
    - 确保 JSON 格式合法，无多余空格或换行。
 """
-        else:
-            return "未知的 filtration_stage"
-
-class ReasoningLLM(LLM):
-    def __init__(self):
-        model_name = os.getenv("REASONING_MODEL_NAME")
-        base_url = os.getenv("REASONING_MODEL_BASE_URL")
-        api_key = os.getenv("REASONING_MODEL_API_KEY")
-        if not model_name:
-            raise ValueError("REASONING_MODEL_NAME 环境变量未设置，请在 .env 文件中配置")
-        if not base_url:
-            raise ValueError("REASONING_MODEL_BASE_URL 环境变量未设置，请在 .env 文件中配置")
-        if not api_key:
-            raise ValueError("REASONING_MODEL_API_KEY 环境变量未设置，请在 .env 文件中配置")
-        super().__init__(model_name=model_name, base_url=base_url, api_key=api_key, temperature=0.7, is_async=False)
+_STAGE_PROMPTS: Final[dict] = {0: _ROUTER_STAGE0_PROMPT, 1: _ROUTER_STAGE1_PROMPT}
+_ROUTER_BATCH_PROMPT: Final[str] = """
+你是一个文档导航助手。用户会给出一个问题和多个带编号的文本块，你的任务是：
+1. 逐块判断文本块是否可能包含回答用户问题的信息。
+2. 为每个文本块记录推理过程。
+3. 返回严格的 JSON 格式，results 中每个输入块对应一项：
+   {
+     "results": [
+       {"chunk_id": 块编号, "is_relevant": true/false, "relevance": 0.0-1.0, "reasoning": "你的推理过程"}
+     ]
+   }
+   - chunk_id 是输入中的块编号（整数）。
+   - is_relevant 是布尔值（true/false，无引号）。
+   - relevance 是 0.0 到 1.0 的浮点数。
+   - reasoning 是双引号包裹的字符串，尽量简短。
+   - 确保 JSON 格式合法，无多余空格或换行。
+"""
 
-    def chat_completion(self, message: str) -> str:
-        system_prompt = """
+_REASONING_PROMPT: Final[str] = """
 你是一个通用文档推理专家，专注于从提供的文档块中提取信息并生成准确、详尽的答案。
 你的任务是：
 1. 仔细分析用户问题。
 2. 根据文档块ID索引，从小到大串联所有文档块，分析前后逻辑关系，了解全局。
 3. 基于文档块提供的事实，生成逻辑清晰、结构化的答案。
 """
-        return self.sync_chat_completion(message, system_prompt)
+_PARSER_PROMPT: Final[str] = """
+你是一个智能助手，任务是从用户输入中提取以下信息：
+1. 用户问题：用户想要查询的具体问题。
+2. 文档路径：本地 PDF 文件的绝对路径。
 
-class VerificationLLM(LLM):
-    def __init__(self):
-        model_name = os.getenv("VERIFICATION_MODEL_NAME")
-        base_url = os.getenv("VERIFICATION_MODEL_BASE_URL")
-        api_key = os.getenv("VERIFICATION_MODEL_API_KEY")
-        if not model_name:
-            raise ValueError("VERIFICATION_MODEL_NAME 环境变量未设置，请在 .env 文件中配置")
-        if not base_url:
-            raise ValueError("VERIFICATION_MODEL_BASE_URL 环境变量未设置，请在 .env 文件中配置")
-        if not api_key:
-            raise ValueError("VERIFICATION_MODEL_API_KEY 环境变量未设置，请在 .env 文件中配置")
-        super().__init__(model_name=model_name, base_url=base_url, api_key=api_key, temperature=0.3, is_async=False)
+输入可能是自然语言，例如：
+- “请回答合同中关于违约责任的规定是什么？文档路径是 D:/docs/contract.pdf”
+- “我想知道违约相关条款，文件在 C:\\documents\\contract.pdf”
+- “帮我查一下合同的签署日期，PDF 文件是 /home/user/contract.pdf”
+
+请分析输入，返回严格的 JSON 格式：
+{
+  "question": "提取的问题",
+  "doc_path": "提取的文档路径",
+  "reasoning": "提取的推理过程"
+}
+- 所有字段是双引号包裹的字符串。
+- 确保 JSON 格式合法，无多余空格或换行。
 
-    def chat_completion(self, message: str, answer: str) -> str:
-        system_prompt = """
+规则：
+- 如果无法提取问题或路径，返回空字符串并在 reasoning 中说明原因。
+- 路径应保留原始格式（包括斜杠或反斜杠）。
+- 路径可能使用 Windows 的反斜杠（例如 C:\\docs\\file.pdf）或 Unix 的正斜杠（例如 /home/user/file.pdf），请正确识别。
+- 如果路径包含空格或特殊字符，保持原样。
+- reasoning 字段解释你的提取逻辑。
+- 问题应简洁，聚焦核心查询内容。
+- 如果输入不明确，尝试推测合理的意图。
+"""
+_VERIFICATION_PROMPT: Final[str] = """
 你是一个通用答案验证助手，任务是验证提供的答案是否准确、完整且与用户问题和文档内容一致。
 返回严格的 JSON 格式：
 {
@@ -161,8 +529,192 @@ class VerificationLLM(LLM):
 - reasoning 是双引号包裹的字符串。
 - 确保 JSON 格式合法，无多余空格或换行。
 """
-        user_message = f"问题: {message}\n答案: {answer}\n请验证答案的准确性并返回 JSON 格式的结果。"
-        return self.sync_chat_completion(user_message, system_prompt)
+
+class RouterLLM(LLM):
+    """路由模型：在 LLM 之上增加进程级并发上限、语义缓存和粗滤/精滤的批量接口。"""
+
+    def __init__(self, *, base_url: str, api_key: str, **kwargs):
+        super().__init__(base_url=base_url, api_key=api_key, **kwargs)
+        # 进程级的路由模型并发上限，由共享该实例的所有查询共同遵守
+        self._sem = asyncio.Semaphore(_ROUTER_MAX_CONCURRENCY)
+        self.semantic_cache = _make_semantic_cache(base_url, api_key, self.model)
+
+    async def chat_completion(
+            self,
+            message: str,
+            filtration_stage: int = 0,
+            cache_key: Optional[Tuple[str, str]] = None
+    ) -> str:
+        """cache_key 为 (用户问题, 块文本) 时查询并写入语义缓存；只有粗滤传入，精滤不缓存。"""
+        system_prompt = self.get_system_prompt(filtration_stage)
+        vector = None
+        if self.semantic_cache is not None and cache_key is not None:
+            cached, vector = await self.semantic_cache.get(*cache_key)
+            if cached is not None:
+                return cached
+        async with self._sem:
+            response = await self.async_chat_completion(message, system_prompt, response_format=JSON_OBJECT_FORMAT)
+        if vector is not None and not response.startswith("错误"):
+            await self.semantic_cache.set(vector, cache_key[1], response)
+        return response
+
+    async def chat_completions_batch(
+            self,
+            messages: List[str],
+            filtration_stage: int = 0,
+            poll_interval: float = 60,
+            min_poll_interval: float = 5
+    ) -> List[str]:
+        """通过 Batch API 提交一批路由请求（24 小时完成窗口），按输入顺序返回结果。
+
+        适用于对延迟不敏感的离线场景：成本约为实时调用的一半。失败的请求以 "错误: ..." 字符串记录错误文件中的原因，
+        未返回结果的请求以通用错误占位。轮询间隔从 min_poll_interval 开始倍增至 poll_interval；协程被取消时一并取消 Batch 任务。
+        """
+        if not messages:
+            return []
+        system_prompt = self.get_system_prompt(filtration_stage)
+        lines = []
+        for i, message in enumerate(messages):
+            request = {
+                "custom_id": f"chunk-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model,
+                    "messages": [
+                        {"role": "system", "content": system_prompt},
+                        {"role": "user", "content": message}
+                    ],
+                    "temperature": self.temperature,
+                    "response_format": JSON_OBJECT_FORMAT
+                }
+            }
+            if self.max_tokens:
+                request["body"]["max_tokens"] = self.max_tokens
+            lines.append(json.dumps(request, ensure_ascii=False))
+        batch_file = await self._acall(
+            self.client.files.create,
+            file=("batch_requests.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self._acall(
+            self.client.batches.create,
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"已提交 Batch 任务 {batch.id}，共 {len(messages)} 个请求")
+        interval = min(min_poll_interval, poll_interval)
+        try:
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, poll_interval)
+                batch = await self._acall(self.client.batches.retrieve, batch.id)
+        except asyncio.CancelledError:
+            logger.warning(f"粗滤被取消，正在取消 Batch 任务 {batch.id}")
+            try:
+                await self._acall(self.client.batches.cancel, batch.id)
+            except Exception as error:
+                logger.warning(f"取消 Batch 任务 {batch.id} 失败: {error!r}")
+            raise
+        logger.info(f"Batch 任务 {batch.id} 结束，状态：{batch.status}")
+
+        results = [f"错误: Batch 任务 {batch.status}，未返回结果"] * len(messages)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                await self._read_batch_results(file_id, results)
+        return results
+
+    async def _read_batch_results(self, file_id: str, results: List[str]):
+        """读取 Batch 的输出或错误文件，按 custom_id 写入 results。"""
+        content = await self._acall(self.client.files.content, file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            index = int(item["custom_id"].split("-", 1)[1])
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                results[index] = response["body"]["choices"][0]["message"]["content"].strip()
+            else:
+                error = item.get("error") or (response.get("body") or {}).get("error") or response
+                results[index] = f"错误: {error}"
+
+    async def batch_classify(self, question: str, chunks: List[Tuple[int, str]]) -> List[Optional[dict]]:
+        """一次调用评估多个文本块的相关性，按输入顺序返回各块结果；响应中缺失的块为 None，整体失败时抛出异常。"""
+        body = "\n\n".join(f"块 {chunk_id}:\n{text}" for chunk_id, text in chunks)
+        message = f"问题: {question}\n\n文本块:\n{body}\n\n请逐块评估相关性，返回 JSON 格式的结果。"
+        async with self._sem:
+            response = await self.async_chat_completion(
+                message, _ROUTER_BATCH_PROMPT, response_format=JSON_OBJECT_FORMAT,
+                max_tokens=self.max_tokens * len(chunks) if self.max_tokens else None
+            )
+        if response.startswith("错误"):
+            raise RuntimeError(response)
+        by_id = {}
+        for item in json.loads(response).get("results", []):
+            try:
+                by_id[int(item["chunk_id"])] = item
+            except (KeyError, TypeError, ValueError):
+                logger.warning(f"批量粗滤结果缺少有效的 chunk_id: {item}")
+        return [by_id.get(chunk_id) for chunk_id, _ in chunks]
+
+    def get_system_prompt(self, filtration_stage: int) -> str:
+        return _STAGE_PROMPTS.get(filtration_stage, "未知的 filtration_stage")
+
+# 各角色的模型配置：环境变量前缀、采样温度、同步/异步客户端、输出上限与预设系统提示词
+_LLM_ROLES: Final[dict] = {
+    "router": {
+        "cls": RouterLLM, "env": "ROUTER", "temperature": 0.5, "is_async": True,
+        "max_tokens": _ROUTER_MAX_TOKENS, "system_prompt": _ROUTER_STAGE0_PROMPT
+    },
+    "reasoning": {
+        "cls": LLM, "env": "REASONING", "temperature": 0.7, "is_async": True,
+        "max_tokens": _REASONING_MAX_TOKENS, "system_prompt": _REASONING_PROMPT
+    },
+    "verification": {
+        "cls": LLM, "env": "VERIFICATION", "temperature": 0.3, "is_async": False,
+        "max_tokens": _VERIFICATION_MAX_TOKENS, "system_prompt": _VERIFICATION_PROMPT
+    },
+    # 从用户输入中提取问题与文档路径，沿用推理模型的配置
+    "parser": {
+        "cls": LLM, "env": "REASONING", "temperature": 0.3, "is_async": False,
+        "max_tokens": None, "system_prompt": _PARSER_PROMPT
+    },
+}
+
+def make_llm(role: str) -> LLM:
+    """按角色配置创建 LLM，环境变量缺失时抛出 ValueError。"""
+    if role not in _LLM_ROLES:
+        raise ValueError(f"未知的 LLM 角色: {role}")
+    config = _LLM_ROLES[role]
+    model_name, base_url, api_key = _require_model_env(config["env"], _MODEL_ENV[config["env"]])
+    return config["cls"](
+        model_name=model_name,
+        base_url=base_url,
+        api_key=api_key,
+        temperature=config["temperature"],
+        is_async=config["is_async"],
+        max_tokens=config["max_tokens"],
+        system_prompt=config["system_prompt"]
+    )
+
+# 进程内共享的 LLM 单例：复用客户端与连接池，避免每次查询重新构造
+@functools.lru_cache(maxsize=1)
+def get_router_llm() -> RouterLLM:
+    return make_llm("router")
+
+@functools.lru_cache(maxsize=1)
+def get_parser_llm() -> LLM:
+    return make_llm("parser")
+
+@functools.lru_cache(maxsize=1)
+def get_reasoning_llm() -> LLM:
+    return make_llm("reasoning")
+
+@functools.lru_cache(maxsize=1)
+def get_verification_llm() -> LLM:
+    return make_llm("verification")
 
 if __name__ == "__main__":
     pass
\ No newline at end of file
@@ -3,10 +3,15 @@ import os
 import logging
 import json
 import re
+import time
 from datetime import datetime
+from typing import List
 
-from agentic_rag import AgenticRAG
-from llm import LLM
+import aiofiles
+
+from pydantic import BaseModel
+
+from llm import close_http_clients, get_parser_llm
 
 # 配置日志
 logging.basicConfig(
@@ -16,20 +21,28 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 文件名中需要去除的非法字符
+_FILENAME_STRIP = re.compile(r'[^\w\s-]')
+
+class ExtractedInput(BaseModel):
+    """LLM 从用户输入中提取的结构化结果。"""
+    question: str
+    doc_path: str
+    reasoning: str
+
 def generate_filename(question: str) -> str:
     """生成唯一的 Markdown 文件名，基于时间戳和问题摘要。"""
-    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
+    timestamp = time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime())
     # 提取问题前 20 个字符，去除非法文件名字符
-    summary = re.sub(r'[^\w\s-]', '', question)[:20].strip().replace(' ', '_')
+    summary = _FILENAME_STRIP.sub('', question)[:20].strip().replace(' ', '_')
     if not summary:
         summary = 'unnamed'
     return f"qa_logs/{timestamp}_{summary}.md"
 
-def save_qa_record(content: str, filename: str):
-    """将问答记录保存为 Markdown 文件。"""
-    os.makedirs('qa_logs', exist_ok=True)
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(content)
+async def save_qa_record(parts: List[str], filename: str):
+    """将问答记录片段拼接后异步写入 Markdown 文件。"""
+    async with aiofiles.open(filename, 'w', encoding='utf-8') as f:
+        await f.write("".join(parts))
     logger.info(f"问答记录已保存至：{filename}")
 
 async def main():
@@ -51,143 +64,113 @@ async def main():
         logger.error("错误：输入不能为空。")
         return
 
-    # 初始化 Markdown 内容
-    md_content = f"# 问答记录\n\n**时间**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    md_content += f"## 用户输入\n```\n{user_input}\n```\n\n"
-
-    llm = LLM(
-        model_name=os.getenv("REASONING_MODEL_NAME"),
-        base_url=os.getenv("REASONING_MODEL_BASE_URL"),
-        api_key=os.getenv("REASONING_MODEL_API_KEY"),
-        temperature=0.3,
-        is_async=False
-    )
-    system_prompt = """
-你是一个智能助手，任务是从用户输入中提取以下信息：
-1. 用户问题：用户想要查询的具体问题。
-2. 文档路径：本地 PDF 文件的绝对路径。
-
-输入可能是自然语言，例如：
-- “请回答合同中关于违约责任的规定是什么？文档路径是 D:/docs/contract.pdf”
-- “我想知道违约相关条款，文件在 C:\\documents\\contract.pdf”
-- “帮我查一下合同的签署日期，PDF 文件是 /home/user/contract.pdf”
-
-请分析输入，返回严格的 JSON 格式：
-{
-  "question": "提取的问题",
-  "doc_path": "提取的文档路径",
-  "reasoning": "提取的推理过程"
-}
-- 所有字段是双引号包裹的字符串。
-- 确保 JSON 格式合法，无多余空格或换行。
-
-规则：
-- 如果无法提取问题或路径，返回空字符串并在 reasoning 中说明原因。
-- 路径应保留原始格式（包括斜杠或反斜杠）。
-- 路径可能使用 Windows 的反斜杠（例如 C:\\docs\\file.pdf）或 Unix 的正斜杠（例如 /home/user/file.pdf），请正确识别。
-- 如果路径包含空格或特殊字符，保持原样。
-- reasoning 字段解释你的提取逻辑。
-- 问题应简洁，聚焦核心查询内容。
-- 如果输入不明确，尝试推测合理的意图。
-"""
+    os.makedirs('qa_logs', exist_ok=True)
+
+    # 初始化 Markdown 内容（按片段收集，保存时一次性拼接）
+    md_parts = [f"# 问答记录\n\n**时间**: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"]
+    md_parts.append(f"## 用户输入\n```\n{user_input}\n```\n\n")
+
+    llm = get_parser_llm()
     user_message = f"用户输入：{user_input}\n请分析并提取问题和文档路径，返回 JSON 格式。"
 
     try:
-        result = llm.sync_chat_completion(user_message, system_prompt)
-        parsed_result = json.loads(result)
-        question = parsed_result.get("question", "").strip()
-        doc_path = parsed_result.get("doc_path", "").strip()
-        reasoning = parsed_result.get("reasoning", "未提供推理")
+        # 同步客户端放到线程池中执行，避免阻塞事件循环
+        extracted = await asyncio.to_thread(llm.sync_parse_completion, user_message, None, ExtractedInput)
+        question = extracted.question.strip()
+        doc_path = extracted.doc_path.strip()
+        reasoning = extracted.reasoning or "未提供推理"
 
         logger.info(f"\nLLM 解析结果：")
         logger.info(f"问题：{question}")
         logger.info(f"文档路径：{doc_path}")
         logger.debug(f"解析推理：{reasoning}")
 
-        md_content += "## LLM 解析结果\n"
-        md_content += f"- **问题**: {question}\n"
-        md_content += f"- **文档路径**: {doc_path}\n"
-        md_content += f"- **解析推理**: {reasoning}\n\n"
+        md_parts.append("## LLM 解析结果\n")
+        md_parts.append(f"- **问题**: {question}\n")
+        md_parts.append(f"- **文档路径**: {doc_path}\n")
+        md_parts.append(f"- **解析推理**: {reasoning}\n\n")
 
         if not question:
             logger.error("错误：无法提取有效问题。")
-            md_content += "## 错误\n无法提取有效问题。\n"
-            save_qa_record(md_content, generate_filename("invalid_question"))
+            md_parts.append("## 错误\n无法提取有效问题。\n")
+            await save_qa_record(md_parts, generate_filename("invalid_question"))
             return
         if not doc_path:
             logger.error("错误：无法提取有效文档路径。")
-            md_content += "## 错误\n无法提取有效文档路径。\n"
-            save_qa_record(md_content, generate_filename("invalid_path"))
+            md_parts.append("## 错误\n无法提取有效文档路径。\n")
+            await save_qa_record(md_parts, generate_filename("invalid_path"))
             return
 
         doc_path = os.path.normpath(doc_path)
         if not os.path.exists(doc_path):
             logger.error(f"错误：文档路径 {doc_path} 不存在，请检查路径是否正确。")
-            md_content += f"## 错误\n文档路径 {doc_path} 不存在。\n"
-            save_qa_record(md_content, generate_filename(question))
+            md_parts.append(f"## 错误\n文档路径 {doc_path} 不存在。\n")
+            await save_qa_record(md_parts, generate_filename(question))
             return
         if not doc_path.lower().endswith('.pdf'):
             logger.error("错误：只支持 PDF 文档，请提供 .pdf 文件。")
-            md_content += "## 错误\n只支持 PDF 文档。\n"
-            save_qa_record(md_content, generate_filename(question))
+            md_parts.append("## 错误\n只支持 PDF 文档。\n")
+            await save_qa_record(md_parts, generate_filename(question))
             return
 
-    except json.JSONDecodeError as e:
-        logger.error(f"错误：LLM 返回无效 JSON：{repr(result)}, 异常：{str(e)}")
-        md_content += f"## 错误\nLLM 返回无效 JSON：\n```\n{repr(result)}\n```\n**异常详情**：{str(e)}\n"
-        save_qa_record(md_content, generate_filename("json_error"))
-        return
     except Exception as e:
         logger.error(f"错误：解析用户输入时出错：{str(e)}")
-        md_content += f"## 错误\n解析用户输入时出错：{str(e)}\n"
-        save_qa_record(md_content, generate_filename("parse_error"))
+        md_parts.append(f"## 错误\n解析用户输入时出错：{str(e)}\n")
+        await save_qa_record(md_parts, generate_filename("parse_error"))
         return
 
     try:
+        # 延迟导入：spawn 方式启动的 PDF 解析子进程会重新导入主模块，顶层导入会让每个子进程都初始化分词词典与 tokenizer
+        from agentic_rag import AgenticRAG
         agent = AgenticRAG(file_path=doc_path, user_question=question)
-        agent.load_local_document()
+        await agent.load_local_document_async()
         chunks = agent.split_into_chunks()
         if not chunks:
             logger.error("错误：文档分块失败，文档可能为空。")
-            md_content += "## 错误\n文档分块失败，文档可能为空。\n"
-            save_qa_record(md_content, generate_filename(question))
+            md_parts.append("## 错误\n文档分块失败，文档可能为空。\n")
+            await save_qa_record(md_parts, generate_filename(question))
             return
 
-        md_content += "## 文档处理\n"
-        md_content += f"- **分块数**: {len(chunks)}\n"
+        md_parts.append("## 文档处理\n")
+        md_parts.append(f"- **分块数**: {len(chunks)}\n")
 
         coarse_result = await agent.coarse_filtration(chunks)
         if not coarse_result["selected_ids"]:
             logger.warning("警告：粗滤阶段未找到相关文档块，可能无法回答问题。")
-            md_content += "- **粗滤结果**: 未找到相关文档块。\n"
+            md_parts.append("- **粗滤结果**: 未找到相关文档块。\n")
         else:
-            md_content += f"- **粗滤结果**: 选中的块 ID: {', '.join(str(chunk_id) for chunk_id in coarse_result['selected_ids'])}\n"
-            md_content += f"  - Scratchpad: ```json\n{json.dumps(coarse_result['scratchpad'], indent=2, ensure_ascii=False)}\n```\n"
+            md_parts.append(f"- **粗滤结果**: 选中的块 ID: {', '.join(str(chunk_id) for chunk_id in coarse_result['selected_ids'])}\n")
+            md_parts.append(f"  - Scratchpad: ```json\n{json.dumps(coarse_result['scratchpad'], indent=2, ensure_ascii=False)}\n```\n")
 
         fine_result = await agent.fine_filtration(coarse_result["scratchpad"])
         if not fine_result["selected_sub_chunks"]:
             logger.warning("警告：精滤阶段未找到相关子块，可能无法生成准确答案。")
-            md_content += "- **精滤结果**: 未找到相关子块。\n"
+            md_parts.append("- **精滤结果**: 未找到相关子块。\n")
         else:
-            md_content += f"- **精滤结果**: 选中的子块数: {len(fine_result['selected_sub_chunks'])}\n"
-            md_content += f"  - Scratchpad: ```\n{json.dumps(fine_result['scratchpad'], indent=2, ensure_ascii=False)}\n```\n"
+            md_parts.append(f"- **精滤结果**: 选中的子块数: {len(fine_result['selected_sub_chunks'])}\n")
+            md_parts.append(f"  - Scratchpad: ```\n{json.dumps(fine_result['scratchpad'], indent=2, ensure_ascii=False)}\n```\n")
 
         paragraphs = [{"id": i, "text": text} for i, text in enumerate(fine_result["selected_sub_chunks"])]
-        answer = agent.generate_answer(question, paragraphs)
+        # 推理阶段流式输出，边生成边打印
+        answer = await agent.generate_answer(question, paragraphs, on_delta=lambda delta: print(delta, end="", flush=True))
+        print()
         if answer["status"] != "success":
             logger.error(f"错误：答案生成失败：{answer['status']}")
-            md_content += f"## 错误\n答案生成失败：{answer['status']}\n"
-            save_qa_record(md_content, generate_filename(question))
+            md_parts.append(f"## 错误\n答案生成失败：{answer['status']}\n")
+            await save_qa_record(md_parts, generate_filename(question))
             return
 
-        is_correct = agent.verify_answer(question, answer)
-        md_content += "## 最终结果\n"
-        md_content += f"- **答案**: \n```\n{answer['answer']}\n```\n"
-        md_content += f"- **答案是否正确**: {'是' if is_correct else '否'}\n"
-        md_content += f"- **使用的文档块 ID**: {', '.join(str(id) for id in answer['source_chunks'])}\n"
+        # 验证答案与渲染 Markdown 并行进行
+        verify_task = asyncio.create_task(asyncio.to_thread(agent.verify_answer, question, answer))
+        md_parts.append("## 最终结果\n")
+        md_parts.append(f"- **答案**: \n```\n{answer['answer']}\n```\n")
+        source_line = f"- **使用的文档块 ID**: {', '.join(str(id) for id in answer['source_chunks'])}\n"
+        is_correct = await verify_task
+        md_parts.append(f"- **答案是否正确**: {'是' if is_correct else '否'}\n")
+        md_parts.append(source_line)
 
         # 保存 Markdown 文件
-        save_qa_record(md_content, generate_filename(question))
+        await save_qa_record(md_parts, generate_filename(question))
 
         # 控制台输出最终结果
         logger.info(f"\n最终结果：")
@@ -196,8 +179,15 @@ async def main():
 
     except Exception as e:
         logger.error(f"处理流程时出错：{str(e)}")
-        md_content += f"## 错误\n处理流程时出错：{str(e)}\n"
-        save_qa_record(md_content, generate_filename(question))
+        md_parts.append(f"## 错误\n处理流程时出错：{str(e)}\n")
+        await save_qa_record(md_parts, generate_filename(question))
+
+async def run():
+    """运行主流程，结束后关闭共享的 HTTP 连接池。"""
+    try:
+        await main()
+    finally:
+        await close_http_clients()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(run())
\ No newline at end of file
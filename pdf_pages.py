@@ -0,0 +1,11 @@
+from typing import List
+
+from pypdf import PdfReader
+
+# 进程池的工作函数单独放在只依赖 pypdf 的轻量模块中：
+# Windows / macOS 以 spawn 方式启动子进程，子进程只需导入本模块，不会触发分词词典、tokenizer 和 HTTP 客户端的初始化。
+
+def extract_pages(file_path: str, start: int, stop: int) -> List[str]:
+    """提取第 start 到 stop-1 页的文本，供进程池调用。"""
+    pdf_reader = PdfReader(file_path)
+    return [pdf_reader.pages[i].extract_text() or "" for i in range(start, stop)]